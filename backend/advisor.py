@@ -1,34 +1,24 @@
-import os, re, csv, json, requests
-from datetime import datetime
-from typing import Dict, List, Any
-
-LLM_API_KEY = os.getenv("LLM_API_KEY")
-if not LLM_API_KEY:
-    raise SystemExit("Missing LLM_API_KEY in env.")
-LLM_URL = "https://api.mistral.ai/v1/chat/completions"
+import os, re, csv, json, math
+import httpx
+from functools import lru_cache
+from typing import AsyncIterator, Dict, List, Any, Optional, Set, Tuple
+
+from backend.llm_utils import JSON_MODE, extract_json, post_chat, post_chat_async, stream_chat_async
+
 LLM_MODEL = "mistral-tiny-latest"   # adjust if needed
 
 KB_CSV = os.getenv("KB_CSV", "data/knowledge_base.csv")
+# prompt budget for retrieved KB text (~4 chars per token → ~500 tokens)
+MAX_KB_CHARS = int(os.getenv("MAX_KB_CHARS", "2000"))
 
 # ---------- utilities ----------
 
-def _extract_json(text: str) -> Dict[str, Any]:
-    text = text.strip()
-    fence = re.match(r"```(?:json)?\s*(.*)```", text, flags=re.S)
-    if fence:
-        text = fence.group(1).strip()
-    try:
-        return json.loads(text)
-    except Exception:
-        pass
-    m = re.search(r"\{.*\}", text, flags=re.S)
-    if m:
-        return json.loads(m.group(0))
-    raise ValueError("Could not parse JSON from model output.")
+_YEAR_RE = re.compile(r"^\s*(\d{4})\s*[-–]\s*(\d{4})\s*$")
+_TOKEN_RE = re.compile(r"\w{3,}")
 
 def _parse_year_range(r: str):
     if not r: return None, None
-    m = re.match(r"^\s*(\d{4})\s*[-–]\s*(\d{4})\s*$", r)
+    m = _YEAR_RE.match(r)
     if m:
         return int(m.group(1)), int(m.group(2))
     # single year or malformed → treat as broad
@@ -41,95 +31,158 @@ def _parse_year_range(r: str):
 def _normalize(s: str) -> str:
     return (s or "").strip().lower()
 
-def load_kb_for_listing(listing: Dict[str, Any]) -> List[str]:
-    """Load KB rows whose brand/model match, and year is in range (if possible). Return list of text chunks."""
-    brand = _normalize(listing.get("brand"))
-    model = _normalize(listing.get("model"))
-    year = listing.get("year")
-    chunks = []
+def _tokens(s: str) -> Set[str]:
+    return set(_TOKEN_RE.findall(s.lower()))
+
+# ---------- KB (loaded once, reloaded if the CSV changes) ----------
+
+_KB_ROWS: List[Dict[str, Any]] = []
+_BRAND_IDX: Dict[str, Set[int]] = {}  # normalized brand → row ids ("" = any brand)
+_KB_IDF: Dict[str, float] = {}        # text token → inverse document frequency
+_KB_MTIME = None
+
+def _load_kb():
+    """Parse KB_CSV into pre-normalized rows + an inverted brand index."""
+    global _KB_ROWS, _BRAND_IDX, _KB_IDF, _KB_MTIME
+    mtime = os.stat(KB_CSV).st_mtime
+    rows, brand_idx = [], {}
     with open(KB_CSV, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            rb, rm = _normalize(row.get("brand")), _normalize(row.get("model"))
-            if brand and rb and brand != rb: 
+        reader = csv.reader(f)  # positional: no per-row dict
+        header = [h.strip() for h in next(reader, [])]
+        pos = {name: header.index(name) if name in header else None
+               for name in ("brand", "model", "year_range", "topic", "text")}
+        for rec in reader:
+            brand, model, yr, topic, txt = (
+                rec[p].strip() if p is not None and p < len(rec) else "" for p in pos.values()
+            )
+            if not txt:
                 continue
-            if model and rm and model not in rm:  # allows "golf 7" match
-                continue
-            y1, y2 = _parse_year_range(row.get("year_range", ""))
-            if isinstance(year, int) and y1 and y2 and not (y1 <= year <= y2):
-                continue
-            txt = row.get("text", "").strip()
-            topic = row.get("topic", "").strip()
-            if txt:
-                chunks.append(f"[{row.get('brand','')}/{row.get('model','')}/{row.get('year_range','')} • {topic}] {txt}")
-    # fall back to whole KB if nothing matched (still better than empty)
-    if not chunks:
-        with open(KB_CSV, newline="", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                txt = row.get("text", "").strip()
-                topic = row.get("topic", "").strip()
-                if txt:
-                    chunks.append(f"[{row.get('brand','')}/{row.get('model','')}/{row.get('year_range','')} • {topic}] {txt}")
-    return chunks[:8]  # keep prompt short
+            y1, y2 = _parse_year_range(yr)
+            rb, rm = brand.lower(), model.lower()
+            i = len(rows)
+            rows.append({
+                "brand": rb,
+                "model": rm,
+                "y1": y1,
+                "y2": y2,
+                "formatted": f"[{brand}/{model}/{yr} • {topic}] {txt}",
+                "tokens": _tokens(f"{rm} {topic} {txt}"),
+            })
+            brand_idx.setdefault(rb, set()).add(i)
+    df: Dict[str, int] = {}
+    for r in rows:
+        for tok in r["tokens"]:
+            df[tok] = df.get(tok, 0) + 1
+    idf = {tok: math.log((1 + len(rows)) / (1 + n)) + 1 for tok, n in df.items()}
+    _KB_ROWS, _BRAND_IDX, _KB_IDF, _KB_MTIME = rows, brand_idx, idf, mtime
+    _kb_lookup.cache_clear()
+
+def _ensure_kb():
+    try:
+        mtime = os.stat(KB_CSV).st_mtime
+    except OSError:
+        if _KB_MTIME is None:
+            raise
+        return  # keep serving the last good copy
+    if mtime != _KB_MTIME:
+        _load_kb()
+
+@lru_cache(maxsize=256)
+def _kb_lookup(brand: str, model: str, year: Optional[int]) -> Tuple[int, ...]:
+    cand = set(range(len(_KB_ROWS)))
+    if brand:
+        # rows without a brand apply to every brand
+        cand = _BRAND_IDX.get(brand, set()) | _BRAND_IDX.get("", set())
+    # model is a substring match ("golf" ↔ "golf 7.5"), so it can't be token-indexed safely
+    matched = []
+    for i in sorted(cand):
+        r = _KB_ROWS[i]
+        if model and r["model"] and model not in r["model"]:  # allows "golf 7" match
+            continue
+        y1, y2 = r["y1"], r["y2"]
+        if year is not None and y1 and y2 and not (y1 <= year <= y2):
+            continue
+        matched.append(i)
+    # no match → no KB context; the prompt says so rather than padding with unrelated cars
+    return tuple(matched)
+
+def _rank_rows(rows: Tuple[int, ...], listing: Dict[str, Any]) -> List[int]:
+    """Order rows by IDF-weighted token overlap with the listing's model / issues / notes."""
+    issues = listing.get("known_issues") or []
+    if isinstance(issues, str):
+        issues = [issues]
+    query = _tokens(" ".join([listing.get("model") or "", listing.get("seller_notes") or "", *map(str, issues)]))
+    if not query:
+        return list(rows)
+    score = lambda i: sum(_KB_IDF.get(t, 0.0) for t in query & _KB_ROWS[i]["tokens"])
+    return sorted(rows, key=score, reverse=True)  # stable: ties keep CSV order
+
+def load_kb_for_listing(listing: Dict[str, Any]) -> List[str]:
+    """Load KB rows whose brand/model match, and year is in range (if possible).
+    Return the most relevant text chunks that fit in MAX_KB_CHARS."""
+    _ensure_kb()
+    year = listing.get("year")
+    rows = _kb_lookup(
+        _normalize(listing.get("brand")),
+        _normalize(listing.get("model")),
+        year if isinstance(year, int) else None,
+    )
+    chunks, used = [], 0
+    for i in _rank_rows(rows, listing):
+        txt = _KB_ROWS[i]["formatted"]
+        if chunks and used + len(txt) > MAX_KB_CHARS:
+            break
+        chunks.append(txt)
+        used += len(txt)
+    return chunks
+
+if os.path.exists(KB_CSV):
+    _load_kb()
 
 # ---------- prompting ----------
 
+# Static prefix: keep it byte-stable (no per-request data) so repeat calls hit
+# the provider's prompt cache. Dynamic content goes in the user message.
 SYSTEM_PROMPT = """You are AutoAdvisor, a cautious, transparent used-car assistant.
-You will produce a single JSON object with this schema:
-{
-  "pros": [], "cons": [], 
-  "price_assessment": "Under|At|Over|Unknown",
-  "mechanical_risk": "Low|Medium|High",
-  "info_completeness": "Low|Medium|High",
-  "questions_to_ask": [],
-  "summary": "",
-  "citations": []  // direct quotes from the ad text that justify key points
-}
-Rules:
-- Output ONLY valid JSON (no extra text).
-- Ground PROS/CONS in the ad text; include short direct quotes in `citations`.
-- Use the KB only for general typical issues and inspection tips (don’t invent facts about this specific car).
-- If you lack info for price, set price_assessment to "Unknown".
-- Keep `summary` ≤ 180 words, friendly and actionable, with clear caveats.
+Reply with ONE JSON object:
+{"pros":[str],"cons":[str],"price_assessment":"Under|At|Over|Unknown","mechanical_risk":"Low|Medium|High","info_completeness":"Low|Medium|High","questions_to_ask":[str],"summary":str,"citations":[str]}
+- pros/cons: grounded in the ad text; back key points with short direct ad quotes in citations.
+- price_assessment: "Unknown" if price info is lacking.
+- mechanical_risk: from model-year typical issues (KB) + ad evidence.
+- info_completeness: given missing key details.
+- questions_to_ask: top 5 for the seller.
+- summary: ≤180 words, friendly, actionable, clear caveats.
+Use the KB only for general issues/inspection tips; never invent facts about this car.
 """
 
 def build_user_message(listing: Dict[str, Any], kb_chunks: List[str]) -> str:
+    """Per-request content only; everything stable lives in SYSTEM_PROMPT so the
+    provider can serve it from its prefix cache."""
     return (
         "Listing facts (JSON):\n"
         f"{json.dumps({k: listing.get(k) for k in ['brand','model','year','mileage_km','price_eur','fuel','transmission','trim','options','service_history','known_issues','seller_notes']}, ensure_ascii=False)}\n\n"
         "Ad text:\n"
         f"<<<{listing.get('text','').strip()}>>>\n\n"
         "Retrieved knowledge (general reliability & inspection notes):\n"
-        + "\n- " + "\n- ".join(kb_chunks)
-        + "\n\nTasks:\n"
-        "1) Extract PROS and CONS grounded in the ad text.\n"
-        "2) Price assessment (Under/At/Over/Unknown) + short rationale.\n"
-        "3) Mechanical risk (Low/Medium/High) based on model-year typical issues and ad evidence.\n"
-        "4) Info completeness (Low/Medium/High) considering missing key details.\n"
-        "5) Top 5 questions to ask the seller.\n"
-        "6) Provide concise `summary` (≤180 words).\n"
+        + ("\n- " + "\n- ".join(kb_chunks) if kb_chunks else "(no KB matches for this car)")
+        + "\n"
     )
 
-def advise(listing: Dict[str, Any]) -> Dict[str, Any]:
+def _build_request(listing: Dict[str, Any]) -> Dict[str, Any]:
     kb_chunks = load_kb_for_listing(listing)
-    user_content = build_user_message(listing, kb_chunks)
-
-    headers = {"Authorization": f"Bearer {LLM_API_KEY}", "Content-Type": "application/json"}
-    data = {
+    return {
         "model": LLM_MODEL,
         "messages": [
             {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": user_content},
+            {"role": "user", "content": build_user_message(listing, kb_chunks)},
         ],
         "temperature": 0.2,
         "max_tokens": 700,
+        "response_format": JSON_MODE,
     }
-    resp = requests.post(LLM_URL, headers=headers, json=data, timeout=45)
-    if resp.status_code != 200:
-        raise RuntimeError(f"LLM error {resp.status_code}: {resp.text}")
-    content = resp.json()["choices"][0]["message"]["content"]
-    out = _extract_json(content)
+
+def _finalize(content: str) -> Dict[str, Any]:
+    out = extract_json(content)
 
     # Minimal normalization / defaults
     out.setdefault("pros", [])
@@ -143,6 +196,18 @@ def advise(listing: Dict[str, Any]) -> Dict[str, Any]:
 
     return out
 
+def advise(listing: Dict[str, Any]) -> Dict[str, Any]:
+    # cache key covers system prompt + listing facts + KB chunks (all inside messages)
+    return post_chat(_build_request(listing), timeout=45, parse=_finalize)
+
+async def advise_async(listing: Dict[str, Any], client: httpx.AsyncClient) -> Dict[str, Any]:
+    return await post_chat_async(_build_request(listing), client, timeout=45, parse=_finalize)
+
+async def advise_stream(listing: Dict[str, Any], client: httpx.AsyncClient) -> AsyncIterator[Tuple[str, Any]]:
+    """Yield ("partial", text_delta) while the model decodes, then ("final", advice_dict)."""
+    async for event in stream_chat_async(_build_request(listing), client, timeout=45, parse=_finalize):
+        yield event
+
 # ---------- CLI: read listing JSON file or stdin ----------
 
 if __name__ == "__main__":
@@ -1,12 +1,19 @@
-import os, json
-from fastapi import FastAPI, HTTPException, Body
+import os, asyncio
+import orjson
+from contextlib import asynccontextmanager
+
+import httpx
+from fastapi import FastAPI, HTTPException, Body, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 from typing import List, Optional, Any, Dict
 
 # local modules
-from backend.extract_listing import extract_listing, insert_listing_to_weaviate
-from backend.advisor import advise
+from backend.extract_listing import (
+    extract_listing_async, extract_listings_batch_async, insert_listing_to_weaviate_async,
+)
+from backend.advisor import advise_async, advise_stream
 
 # --- env checks ---
 REQUIRED_ENV = ["LLM_API_KEY", "WCS_URL", "WCS_API_KEY"]
@@ -14,15 +21,26 @@ missing = [k for k in REQUIRED_ENV if not os.getenv(k)]
 if missing:
     raise SystemExit(f"Missing env vars: {', '.join(missing)}")
 
-app = FastAPI(title="AutoAdvisor API", version="0.1.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # one pooled client for Mistral + Weaviate, shared by all requests
+    limits = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30)
+    async with httpx.AsyncClient(http2=True, limits=limits) as client:
+        app.state.http = client
+        yield
+
+app = FastAPI(title="AutoAdvisor API", version="0.1.0", lifespan=lifespan)
+
+# Allow Bubble to call this API from browser (comma-separated list of origins)
+BUBBLE_ORIGINS = [o.strip() for o in os.getenv("BUBBLE_ORIGIN", "https://yourapp.bubbleapps.io").split(",") if o.strip()]
 
-# Allow Bubble to call this API from browser
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],   # tighten to your Bubble domain later
+    allow_origins=BUBBLE_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
+    allow_methods=["GET", "POST"],
     allow_headers=["*"],
+    max_age=86400,   # let browsers cache preflight responses for 24h
 )
 
 class AnalyzeRequest(BaseModel):
@@ -35,21 +53,93 @@ class AnalyzeResponse(BaseModel):
     weaviate_id: Optional[str] = None
 
 @app.post("/analyze", response_model=AnalyzeResponse)
-def analyze(req: AnalyzeRequest = Body(...)):
+async def analyze(request: Request, req: AnalyzeRequest = Body(...)):
+    client = request.app.state.http
     try:
         # 1) Extract
-        listing = extract_listing(req.ad_text)
+        listing = await extract_listing_async(req.ad_text, client)
         if req.source_url:
             listing["source_url"] = req.source_url
 
-        # 2) Store in Weaviate
-        inserted = insert_listing_to_weaviate(listing)
+        # 2) Store in Weaviate + 3) Advise (RAG over local KB CSV) — independent, run concurrently
+        inserted, advisor = await asyncio.gather(
+            insert_listing_to_weaviate_async(listing, client),
+            advise_async(listing, client),
+        )
         weaviate_id = inserted.get("id")
 
-        # 3) Advise (RAG over local KB CSV)
-        advisor = advise(listing)
-
         return AnalyzeResponse(listing=listing, advisor=advisor, weaviate_id=weaviate_id)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+# listings processed (Weaviate insert + advise) concurrently per /analyze/batch request
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+# ads accepted per /analyze/batch request; longer lists get a 422
+MAX_BATCH_ADS = int(os.getenv("MAX_BATCH_ADS", "50"))
+
+@app.post("/analyze/batch", response_model=List[AnalyzeResponse])
+async def analyze_batch(request: Request, reqs: List[AnalyzeRequest] = Body(..., max_length=MAX_BATCH_ADS)):
+    client = request.app.state.http
+    try:
+        # 1) Extract the ads, one LLM call per MAX_BATCH ads
+        listings = await extract_listings_batch_async([r.ad_text for r in reqs], client)
+        for r, listing in zip(reqs, listings):
+            if r.source_url:
+                listing["source_url"] = r.source_url
+
+        # 2) + 3) Store and advise each listing, at most BATCH_CONCURRENCY listings in flight
+        slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+        async def _process(listing):
+            async with slots:
+                return await asyncio.gather(
+                    insert_listing_to_weaviate_async(listing, client),
+                    advise_async(listing, client),
+                )
+
+        results = await asyncio.gather(*(_process(listing) for listing in listings))
+
+        return [
+            AnalyzeResponse(listing=listing, advisor=advisor, weaviate_id=inserted.get("id"))
+            for listing, (inserted, advisor) in zip(listings, results)
+        ]
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def _sse(event: str, data: Any) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+@app.post("/analyze/stream")
+async def analyze_stream(request: Request, req: AnalyzeRequest = Body(...)):
+    """Same pipeline as /analyze, as Server-Sent Events: `partial` events carry raw
+    advisor tokens as they decode, `final` carries the AnalyzeResponse body."""
+    client = request.app.state.http
+
+    async def events():
+        try:
+            listing = await extract_listing_async(req.ad_text, client)
+            if req.source_url:
+                listing["source_url"] = req.source_url
+
+            insert = asyncio.create_task(insert_listing_to_weaviate_async(listing, client))
+            try:
+                async for kind, payload in advise_stream(listing, client):
+                    if kind == "partial":
+                        yield _sse("partial", payload)
+                    else:
+                        advisor = payload
+            except Exception:
+                # like /analyze: a failed advice call doesn't abort the Weaviate insert
+                await asyncio.gather(insert, return_exceptions=True)
+                raise
+            inserted = await insert
+
+            body = AnalyzeResponse(listing=listing, advisor=advisor, weaviate_id=inserted.get("id"))
+            yield _sse("final", body.model_dump())
+        except Exception as e:
+            yield _sse("error", {"detail": str(e)})
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -0,0 +1,84 @@
+import os, json, time, hashlib, threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+CACHE_TTL_S = float(os.getenv("LLM_CACHE_TTL_S", "3600"))
+CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1000"))
+# Sampling above this temperature is treated as non-deterministic → never cached.
+CACHE_MAX_TEMPERATURE = float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", "0.2"))
+
+
+def make_key(model: str, messages: List[Dict[str, Any]]) -> str:
+    """Stable SHA-256 fingerprint of a chat request."""
+    payload = json.dumps(messages, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(f"{model}\n{payload}".encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Thread-safe in-memory cache with TTL expiry and LFU eviction."""
+
+    def __init__(self, ttl: float = CACHE_TTL_S, max_entries: int = CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> [stored_at, hits, value]
+        self._data: Dict[str, list] = {}
+
+    @staticmethod
+    def cacheable(temperature: float) -> bool:
+        return temperature <= CACHE_MAX_TEMPERATURE
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                del self._data[key]
+                return None
+            entry[1] += 1
+            return entry[2]
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            if key not in self._data and len(self._data) >= self.max_entries:
+                self._evict()
+            self._data[key] = [time.monotonic(), 0, value]
+
+    def get_or_call(self, key: str, fn: Callable[[], Any], temperature: float = 0.0) -> Any:
+        if not self.cacheable(temperature):
+            return fn()
+        hit = self.get(key)
+        if hit is not None:
+            return hit
+        value = fn()
+        self.set(key, value)
+        return value
+
+    async def aget_or_call(self, key: str, fn: Callable[[], Awaitable[Any]], temperature: float = 0.0) -> Any:
+        """Async twin of get_or_call; fn is a coroutine function."""
+        if not self.cacheable(temperature):
+            return await fn()
+        hit = self.get(key)
+        if hit is not None:
+            return hit
+        value = await fn()
+        self.set(key, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def _evict(self) -> None:
+        # drop expired entries first, then the least frequently used one
+        now = time.monotonic()
+        expired = [k for k, e in self._data.items() if now - e[0] > self.ttl]
+        for k in expired:
+            del self._data[k]
+        if len(self._data) >= self.max_entries:
+            victim = min(self._data.items(), key=lambda kv: (kv[1][1], kv[1][0]))[0]
+            del self._data[victim]
+
+
+# shared by extract_listing and advisor
+response_cache = ResponseCache()
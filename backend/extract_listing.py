@@ -1,12 +1,14 @@
-import os, re, json, requests
-from datetime import datetime
+import os, json, math, asyncio
+import httpx, orjson
+from datetime import datetime, timezone
+from typing import Any, List, Optional
 
-LLM_API_KEY = os.getenv("LLM_API_KEY")
-if not LLM_API_KEY:
-    raise SystemExit("Missing LLM_API_KEY in environment.")
+from pydantic import BaseModel, Field, field_validator
+
+from backend.llm_utils import (
+    SESSION, JSON_MODE, extract_json, post_chat, post_chat_async,
+)
 
-# Adjust if you use a different provider
-LLM_URL = "https://api.mistral.ai/v1/chat/completions"
 LLM_MODEL = "mistral-small-latest"
 
 EXTRACTION_SYSTEM = """You are an automotive data extractor.
@@ -25,44 +27,37 @@ Rules:
 - Do not invent facts that aren’t in the ad.
 """
 
+# ads per batched extraction call; bounds max_tokens (400/ad, doubled on truncation retry)
+MAX_BATCH = int(os.getenv("MAX_BATCH", "10"))
+# batched extraction calls in flight at once (extract_listings_batch_async)
+EXTRACT_CONCURRENCY = int(os.getenv("EXTRACT_CONCURRENCY", "4"))
+
 WCS_URL = os.getenv("WCS_URL")
 WCS_API_KEY = os.getenv("WCS_API_KEY")
 
+class _DigitsOnly(dict):
+    """str.translate table: keep ASCII 0-9, drop everything else (incl. €, NBSP)."""
+    def __missing__(self, key):
+        return None
+
+_DIGITS_ONLY = _DigitsOnly((c, c) for c in range(48, 58))
+
 def _coerce_number(x):
     if x is None:
         return None
+    if isinstance(x, float) and not math.isfinite(x):
+        return None
     if isinstance(x, (int, float)):
         return int(x)
-    s = str(x)
-    # remove currency, km, thousands sep, commas
-    s = re.sub(r"[€\s,kmKM]", "", s)
-    s = re.sub(r"[^\d]", "", s)
-    return int(s) if s.isdigit() else None
-
-def _extract_json(text):
-    """
-    Try to parse JSON; if the model wrapped it in code fences or added text,
-    extract the first {...} block.
-    """
-    text = text.strip()
-    # Remove ```json fences if present
-    fence = re.match(r"```(?:json)?\s*(.*)```", text, flags=re.S)
-    if fence:
-        text = fence.group(1).strip()
-    # Try direct JSON
-    try:
-        return json.loads(text)
-    except Exception:
-        pass
-    # Fallback: get first {...} block
-    m = re.search(r"\{.*\}", text, flags=re.S)
-    if m:
-        return json.loads(m.group(0))
-    raise ValueError("Could not parse JSON from model output.")
+    # "11 500€" / "98,000 km" → "11500" / "98000" in a single pass
+    s = str(x).translate(_DIGITS_ONLY)
+    return int(s) if s else None
 
-def extract_listing(ad_text):
-    headers = {"Authorization": f"Bearer {LLM_API_KEY}", "Content-Type": "application/json"}
-    data = {
+def _wcs_headers():
+    return {"Authorization": f"Bearer {WCS_API_KEY}", "Content-Type": "application/json"}
+
+def _build_request(ad_text):
+    return {
         "model": LLM_MODEL,
         "messages": [
             {"role": "system", "content": EXTRACTION_SYSTEM},
@@ -70,50 +65,158 @@ def extract_listing(ad_text):
         ],
         "temperature": 0.0,
         "max_tokens": 400,
+        "response_format": JSON_MODE,
     }
-    resp = requests.post(LLM_URL, headers=headers, json=data, timeout=30)
-    if resp.status_code != 200:
-        raise RuntimeError(f"LLM error {resp.status_code}: {resp.text}")
-
-    try:
-        content = resp.json()["choices"][0]["message"]["content"]
-    except Exception as e:
-        raise RuntimeError(f"Unexpected LLM response format: {resp.text}") from e
-
-    data = _extract_json(content)
-
-    # Normalize & coerce fields (as before) …
-    out = {
-        "brand": (str(data.get("brand")).title().strip() if data.get("brand") else None),
-        "model": (str(data.get("model")).strip() if data.get("model") else None),
-        "year": _coerce_number(data.get("year")),
-        "mileage_km": _coerce_number(data.get("mileage_km")),
-        "price_eur": _coerce_number(data.get("price_eur")),
-        "fuel": data.get("fuel"),
-        "transmission": data.get("transmission"),
-        "trim": data.get("trim"),
-        "options": data.get("options") or [],
-        "service_history": data.get("service_history"),
-        "known_issues": data.get("known_issues") or [],
-        "seller_notes": data.get("seller_notes"),
-        "text": data.get("text") or ad_text,
-        "created_at": datetime.utcnow().isoformat() + "Z",
+
+def _utc_now():
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+class Listing(BaseModel):
+    """Normalized listing; validators coerce the model's loosely-typed output."""
+    brand: Optional[str] = None
+    model: Optional[str] = None
+    year: Optional[int] = None
+    mileage_km: Optional[int] = None
+    price_eur: Optional[int] = None
+    fuel: Optional[str] = None
+    transmission: Optional[str] = None
+    trim: Optional[str] = None
+    options: List[Any] = []
+    service_history: Optional[str] = None
+    known_issues: List[Any] = []
+    seller_notes: Optional[str] = None
+    text: str
+    created_at: str = Field(default_factory=_utc_now)
+
+    @field_validator("year", "mileage_km", "price_eur", mode="before")
+    @classmethod
+    def _number(cls, v):
+        return _coerce_number(v)
+
+    @field_validator("brand", mode="before")
+    @classmethod
+    def _brand(cls, v):
+        return str(v).title().strip() if v else None
+
+    @field_validator("model", mode="before")
+    @classmethod
+    def _model(cls, v):
+        return str(v).strip() if v else None
+
+    @field_validator("fuel", "transmission", "trim", "service_history", "seller_notes", "text", mode="before")
+    @classmethod
+    def _text(cls, v):
+        return v if v is None or isinstance(v, str) else str(v)
+
+    @field_validator("options", "known_issues", mode="before")
+    @classmethod
+    def _list(cls, v):
+        if not v:
+            return []
+        return v if isinstance(v, list) else [v]
+
+def _normalize_listing(data, ad_text):
+    # "created_at" is always stamped locally, never taken from the model
+    data = {k: v for k, v in data.items() if k != "created_at"}
+    data["text"] = data.get("text") or ad_text
+    return Listing.model_validate(data).model_dump()
+
+def _parse_listing(content):
+    data = extract_json(content)
+    if not isinstance(data, dict):
+        raise ValueError("Extraction returned a non-object listing.")
+    return data
+
+def extract_listing(ad_text):
+    # identical ad text → same extraction; served from the response cache
+    data = post_chat(_build_request(ad_text), timeout=30, parse=_parse_listing)
+    return _normalize_listing(data, ad_text)
+
+async def extract_listing_async(ad_text, client: httpx.AsyncClient):
+    data = await post_chat_async(_build_request(ad_text), client, timeout=30, parse=_parse_listing)
+    return _normalize_listing(data, ad_text)
+
+def _build_batch_request(ads):
+    parts = [f"Extract each of the {len(ads)} ads below. Return ONE JSON object "
+             '{"listings": [...]} holding one object per ad, in the same order, '
+             'each matching the schema. Set "text" to null (it is filled in locally).']
+    for i, ad in enumerate(ads, 1):
+        parts.append(f"---AD {i}---\n{ad}")
+    return {
+        "model": LLM_MODEL,
+        "messages": [
+            # same system prompt as single extraction → shared cached prefix
+            {"role": "system", "content": EXTRACTION_SYSTEM},
+            {"role": "user", "content": "\n".join(parts)}
+        ],
+        "temperature": 0.0,
+        "max_tokens": 400 * len(ads),
+        "response_format": JSON_MODE,
     }
+
+def _parse_batch(content, n):
+    """Validate a batch reply: exactly n listing objects, in order."""
+    items = extract_json(content).get("listings")
+    if not isinstance(items, list) or len(items) != n:
+        got = len(items) if isinstance(items, list) else 0
+        raise ValueError(f"Batch extraction returned {got} listings for {n} ads.")
+    bad = [i for i, d in enumerate(items, 1) if not isinstance(d, dict)]
+    if bad:
+        raise ValueError(f"Batch extraction returned non-object listings for ads {bad}.")
+    return items
+
+def _chunks(ads):
+    return [ads[i:i + MAX_BATCH] for i in range(0, len(ads), MAX_BATCH)]
+
+def extract_listings_batch(ads):
+    """Extract several ads with one LLM call per MAX_BATCH ads; results keep input order."""
+    out = []
+    for chunk in _chunks(ads):
+        items = post_chat(_build_batch_request(chunk), timeout=60,
+                          parse=lambda content: _parse_batch(content, len(chunk)))
+        out.extend(_normalize_listing(d, ad) for d, ad in zip(items, chunk))
     return out
 
+async def extract_listings_batch_async(ads, client: httpx.AsyncClient):
+    slots = asyncio.Semaphore(EXTRACT_CONCURRENCY)
+
+    async def _one(chunk):
+        async with slots:
+            items = await post_chat_async(_build_batch_request(chunk), client, timeout=60,
+                                          parse=lambda content: _parse_batch(content, len(chunk)))
+        return [_normalize_listing(d, ad) for d, ad in zip(items, chunk)]
+
+    results = await asyncio.gather(*(_one(c) for c in _chunks(ads)))
+    return [listing for chunk in results for listing in chunk]
+
+def _read_weaviate(r):
+    if r.status_code not in (200, 202):
+        raise RuntimeError(f"Weaviate insert failed {r.status_code}: {r.text}")
+    return orjson.loads(r.content)
+
 def insert_listing_to_weaviate(listing: dict):
     if not WCS_URL or not WCS_API_KEY:
         raise SystemExit("Missing WCS_URL or WCS_API_KEY in environment.")
     payload = {"class": "Listing", "properties": listing}
-    r = requests.post(
+    r = SESSION.post(
         f"{WCS_URL}/v1/objects",
-        headers={"Authorization": f"Bearer {WCS_API_KEY}", "Content-Type": "application/json"},
-        json=payload,
+        headers=_wcs_headers(),
+        data=orjson.dumps(payload),
         timeout=30,
     )
-    if r.status_code not in (200, 202):
-        raise RuntimeError(f"Weaviate insert failed {r.status_code}: {r.text}")
-    return r.json()
+    return _read_weaviate(r)
+
+async def insert_listing_to_weaviate_async(listing: dict, client: httpx.AsyncClient):
+    if not WCS_URL or not WCS_API_KEY:
+        raise SystemExit("Missing WCS_URL or WCS_API_KEY in environment.")
+    payload = {"class": "Listing", "properties": listing}
+    r = await client.post(
+        f"{WCS_URL}/v1/objects",
+        headers=_wcs_headers(),
+        content=orjson.dumps(payload),
+        timeout=30,
+    )
+    return _read_weaviate(r)
 
 if __name__ == "__main__":
     print("Paste a car listing text (end with Enter):")
@@ -0,0 +1,141 @@
+import os, re, copy, itertools, requests
+from requests.adapters import HTTPAdapter
+import httpx, orjson
+
+from backend.cache import response_cache, make_key
+
+LLM_API_KEY = os.getenv("LLM_API_KEY")
+if not LLM_API_KEY:
+    raise SystemExit("Missing LLM_API_KEY in environment.")
+
+# Adjust if you use a different provider
+LLM_URL = "https://api.mistral.ai/v1/chat/completions"
+
+# JSON mode: the provider constrains decoding to a single valid JSON object
+JSON_MODE = {"type": "json_object"}
+# on truncation (finish_reason == "length") retry with a larger budget, this many times
+TRUNCATION_RETRIES = 1
+
+# cold path only: backends that ignore response_format may still fence or pad the JSON
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*)```", re.S)
+_JSON_RE = re.compile(r"\{.*\}", re.S)
+
+# keep-alive: reuse TCP+TLS connections across LLM / Weaviate calls
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+SESSION.mount("http://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+
+def extract_json(text):
+    """Parse the model output. JSON mode gives a bare object (fast path);
+    fall back to stripping ```json fences / grabbing the first {...} block."""
+    text = text.lstrip()
+    if text.startswith("{"):
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    fence = _FENCE_RE.match(text)
+    if fence:
+        text = fence.group(1).strip()
+    m = _JSON_RE.search(text)
+    if m:
+        try:
+            return orjson.loads(m.group(0))
+        except orjson.JSONDecodeError:
+            pass
+    raise ValueError("Could not parse JSON from model output.")
+
+def llm_headers():
+    return {"Authorization": f"Bearer {LLM_API_KEY}", "Content-Type": "application/json"}
+
+def _read_choice(resp):
+    """Pull the first choice out of a chat-completions response (requests or httpx)."""
+    if resp.status_code != 200:
+        raise RuntimeError(f"LLM error {resp.status_code}: {resp.text}")
+    try:
+        choice = orjson.loads(resp.content)["choices"][0]
+        content = choice["message"]["content"]
+    except Exception as e:
+        raise RuntimeError(f"Unexpected LLM response format: {resp.text}") from e
+    if not isinstance(content, str):
+        raise RuntimeError(f"Unexpected LLM response format: {resp.text}")
+    return choice
+
+def _next_body(choice, body, attempt):
+    """Retry decision shared by post_chat/post_chat_async: None when the reply is
+    complete, else the body to re-send with doubled max_tokens; raises once
+    TRUNCATION_RETRIES are used up."""
+    if choice.get("finish_reason") != "length":
+        return None
+    if attempt >= TRUNCATION_RETRIES:
+        raise RuntimeError(f"LLM output truncated at max_tokens={body['max_tokens']}.")
+    return {**body, "max_tokens": body["max_tokens"] * 2}
+
+def post_chat(data, timeout, parse=extract_json):
+    """POST a chat request; re-ask with more max_tokens if the output was cut off.
+    Returns parse(content). Only replies that parse are cached, so a malformed
+    one is re-requested next time instead of replayed."""
+    def _call():
+        body = data
+        for attempt in itertools.count():
+            resp = SESSION.post(LLM_URL, headers=llm_headers(), data=orjson.dumps(body), timeout=timeout)
+            choice = _read_choice(resp)
+            body = _next_body(choice, body, attempt)
+            if body is None:
+                return parse(choice["message"]["content"])
+
+    key = make_key(data["model"], data["messages"])
+    # callers mutate what they get back; never hand out the cached object itself
+    return copy.deepcopy(response_cache.get_or_call(key, _call, temperature=data["temperature"]))
+
+async def post_chat_async(data, client: httpx.AsyncClient, timeout, parse=extract_json):
+    async def _call():
+        body = data
+        for attempt in itertools.count():
+            resp = await client.post(LLM_URL, headers=llm_headers(), content=orjson.dumps(body), timeout=timeout)
+            choice = _read_choice(resp)
+            body = _next_body(choice, body, attempt)
+            if body is None:
+                return parse(choice["message"]["content"])
+
+    key = make_key(data["model"], data["messages"])
+    return copy.deepcopy(await response_cache.aget_or_call(key, _call, temperature=data["temperature"]))
+
+async def stream_chat_async(data, client: httpx.AsyncClient, timeout, parse=extract_json):
+    """Stream a chat request over SSE: yields ("partial", text_delta) as tokens
+    arrive, then ("final", parse(full_text)). A cache hit yields only the final
+    event; a stream is cached once its full text parses."""
+    key = make_key(data["model"], data["messages"])
+    cacheable = response_cache.cacheable(data["temperature"])
+    hit = response_cache.get(key) if cacheable else None
+    if hit is not None:
+        yield "final", copy.deepcopy(hit)
+        return
+
+    # partials can't be retracted, so instead of retrying on truncation give the
+    # stream up front the budget post_chat would reach after its retries
+    max_tokens = data["max_tokens"] * 2 ** TRUNCATION_RETRIES
+    parts, finish = [], None
+    body = orjson.dumps({**data, "max_tokens": max_tokens, "stream": True})
+    async with client.stream("POST", LLM_URL, headers=llm_headers(), content=body, timeout=timeout) as resp:
+        if resp.status_code != 200:
+            await resp.aread()
+            raise RuntimeError(f"LLM error {resp.status_code}: {resp.text}")
+        async for line in resp.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == "[DONE]":
+                break
+            choice = orjson.loads(payload)["choices"][0]
+            delta = (choice.get("delta") or {}).get("content")
+            if delta:
+                parts.append(delta)
+                yield "partial", delta
+            finish = choice.get("finish_reason") or finish
+    if finish == "length":
+        raise RuntimeError(f"LLM output truncated at max_tokens={max_tokens}.")
+    value = parse("".join(parts))
+    if cacheable:
+        response_cache.set(key, value)
+    yield "final", copy.deepcopy(value)
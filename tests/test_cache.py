@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from backend import cache
+from backend.cache import ResponseCache, make_key
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_entry_expires_after_ttl(clock):
+    c = ResponseCache(ttl=10, max_entries=5)
+    c.set("k", "v")
+    clock[0] += 10
+    assert c.get("k") == "v"
+    clock[0] += 0.1
+    assert c.get("k") is None
+
+
+def test_full_cache_evicts_least_hit_entry(clock):
+    c = ResponseCache(ttl=100, max_entries=3)
+    for k in "abc":
+        c.set(k, k)
+    c.get("a"), c.get("a"), c.get("c")
+    c.set("d", "d")
+    assert c.get("b") is None
+    assert [c.get(k) for k in "acd"] == ["a", "c", "d"]
+
+
+def test_full_cache_drops_expired_entries_first(clock):
+    c = ResponseCache(ttl=10, max_entries=2)
+    c.set("old", 1)
+    c.get("old")  # more hits than "new", but expired by the time we evict
+    clock[0] += 5
+    c.set("new", 2)
+    clock[0] += 6
+    c.set("newest", 3)
+    assert c.get("old") is None
+    assert c.get("new") == 2 and c.get("newest") == 3
+
+
+def test_get_or_call_bypasses_cache_above_max_temperature():
+    c = ResponseCache()
+    calls = []
+    fn = lambda: calls.append(1) or len(calls)
+    hot = cache.CACHE_MAX_TEMPERATURE + 0.1
+    assert [c.get_or_call("k", fn, temperature=hot) for _ in range(2)] == [1, 2]
+    assert c.get("k") is None
+    assert [c.get_or_call("k", fn, temperature=0.0) for _ in range(2)] == [3, 3]
+
+
+def test_aget_or_call_matches_get_or_call():
+    sync_c, async_c = ResponseCache(), ResponseCache()
+    sync_calls, async_calls = [], []
+
+    def fn():
+        sync_calls.append(1)
+        return len(sync_calls)
+
+    async def afn():
+        async_calls.append(1)
+        return len(async_calls)
+
+    async def run(temperature):
+        return [await async_c.aget_or_call("k", afn, temperature=temperature) for _ in range(2)]
+
+    for t in (cache.CACHE_MAX_TEMPERATURE + 0.1, 0.0):
+        expected = [sync_c.get_or_call("k", fn, temperature=t) for _ in range(2)]
+        assert asyncio.run(run(t)) == expected
+
+
+def test_make_key_is_order_insensitive_and_model_sensitive():
+    msgs_a = [{"role": "user", "content": "x"}]
+    msgs_b = [{"content": "x", "role": "user"}]
+    assert make_key("m", msgs_a) == make_key("m", msgs_b)
+    assert make_key("m", msgs_a) != make_key("n", msgs_a)
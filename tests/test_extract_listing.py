@@ -0,0 +1,77 @@
+import asyncio, json
+
+import pytest
+
+from backend import extract_listing
+from backend.extract_listing import _coerce_number, _normalize_listing, _parse_batch
+
+
+@pytest.mark.parametrize("raw,expected", [
+    ("11 500€", 11500),
+    ("98 000 km", 98000),
+    (2016, 2016),
+    (95000.0, 95000),
+    (float("nan"), None),
+    (float("inf"), None),
+    ("n/a", None),
+    (None, None),
+])
+def test_coerce_number(raw, expected):
+    assert _coerce_number(raw) == expected
+
+
+def test_normalize_listing_tolerates_loose_types():
+    out = _normalize_listing({"brand": "peugeot ", "text": 123, "trim": 82, "year": float("nan"),
+                              "known_issues": "rust", "created_at": "model-made"}, "AD")
+    assert out["brand"] == "Peugeot"
+    assert out["text"] == "123"
+    assert out["trim"] == "82"
+    assert out["year"] is None
+    assert out["known_issues"] == ["rust"]
+    assert out["created_at"] != "model-made"
+
+
+def test_normalize_listing_falls_back_to_ad_text():
+    assert _normalize_listing({"text": None}, "AD")["text"] == "AD"
+
+
+def test_batch_is_split_into_max_batch_chunks(monkeypatch):
+    calls = []
+
+    def fake_post_chat(data, timeout, parse):
+        n = data["messages"][1]["content"].count("---AD ")
+        calls.append((n, data["max_tokens"]))
+        return parse(json.dumps({"listings": [{"brand": "x"}] * n}))
+
+    monkeypatch.setattr(extract_listing, "MAX_BATCH", 4)
+    monkeypatch.setattr(extract_listing, "post_chat", fake_post_chat)
+    ads = [f"ad {i}" for i in range(10)]
+    out = extract_listing.extract_listings_batch(ads)
+    assert [n for n, _ in calls] == [4, 4, 2]
+    assert max(t for _, t in calls) == 400 * 4
+    assert [listing["text"] for listing in out] == ads
+
+
+def test_parse_batch_rejects_non_object_items():
+    with pytest.raises(ValueError, match="non-object"):
+        _parse_batch(json.dumps({"listings": [{"brand": "x"}, "oops"]}), 2)
+
+
+def test_async_batch_bounds_concurrent_llm_calls(monkeypatch):
+    in_flight, peak = [0], [0]
+
+    async def fake_post_chat_async(data, client, timeout, parse):
+        in_flight[0] += 1
+        peak[0] = max(peak[0], in_flight[0])
+        await asyncio.sleep(0.01)
+        in_flight[0] -= 1
+        n = data["messages"][1]["content"].count("---AD ")
+        return parse(json.dumps({"listings": [{"brand": "x"}] * n}))
+
+    monkeypatch.setattr(extract_listing, "MAX_BATCH", 2)
+    monkeypatch.setattr(extract_listing, "EXTRACT_CONCURRENCY", 3)
+    monkeypatch.setattr(extract_listing, "post_chat_async", fake_post_chat_async)
+    ads = [f"ad {i}" for i in range(20)]
+    out = asyncio.run(extract_listing.extract_listings_batch_async(ads, client=None))
+    assert [listing["text"] for listing in out] == ads
+    assert peak[0] == 3
@@ -0,0 +1,84 @@
+import csv
+
+import pytest
+
+from backend import advisor
+
+ROWS = [
+    ("Volkswagen", "Golf 7.5", "2017-2020", "failure_points", "golf 7.5 note"),
+    ("Volkswagen", "Polo 7", "2017-2022", "failure_points", "polo 7 note"),
+    ("Volkswagen", "Golf-7", "2013-2019", "inspection", "golf-7 note"),
+    ("BMW", "Série 3", "2012-2019", "inspection", "serie 3 note"),
+    ("", "", "", "general", "applies to every car"),
+]
+
+
+@pytest.fixture
+def kb(tmp_path, monkeypatch):
+    path = tmp_path / "kb.csv"
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(["brand", "model", "year_range", "topic", "text"])
+        w.writerows(ROWS)
+    monkeypatch.setattr(advisor, "KB_CSV", str(path))
+    advisor._load_kb()
+    return path
+
+
+def _reference(brand, model, year):
+    """Baseline matching: linear scan, brand equality, model substring, year in range."""
+    brand, model = advisor._normalize(brand), advisor._normalize(model)
+    out = []
+    for rb, rm, yr, _topic, _txt in ROWS:
+        rb, rm = advisor._normalize(rb), advisor._normalize(rm)
+        if brand and rb and brand != rb:
+            continue
+        if model and rm and model not in rm:
+            continue
+        y1, y2 = advisor._parse_year_range(yr)
+        if isinstance(year, int) and y1 and y2 and not (y1 <= year <= y2):
+            continue
+        out.append(f"{rm}|{_txt}")
+    return out
+
+
+@pytest.mark.parametrize("brand,model,year", [
+    ("Volkswagen", "Golf 7", None),
+    ("volkswagen", "golf", None),
+    ("Volkswagen", "olf 7", None),
+    ("Volkswagen", "Golf 7", 2018),
+    ("Volkswagen", "Polo", 2010),
+    ("BMW", "série 3", 2015),
+    ("Fiat", "Panda", None),
+    (None, "7", None),
+    (None, None, None),
+])
+def test_kb_lookup_matches_linear_scan(kb, brand, model, year):
+    got = advisor._kb_lookup(advisor._normalize(brand), advisor._normalize(model), year)
+    assert [f"{advisor._KB_ROWS[i]['model']}|{ROWS[i][4]}" for i in got] == _reference(brand, model, year)
+
+
+def test_issue_matching_row_ranks_first(kb, monkeypatch):
+    monkeypatch.setattr(advisor, "MAX_KB_CHARS", 10_000)
+    chunks = advisor.load_kb_for_listing({"brand": "Volkswagen", "known_issues": ["Polo rattles"]})
+    assert len(chunks) == 4  # three VW rows + the brand-less one
+    assert "polo 7 note" in chunks[0]
+
+
+def test_chunks_stop_at_first_that_does_not_fit(kb, monkeypatch):
+    listing = {"brand": "Volkswagen", "known_issues": ["Polo rattles"]}
+    monkeypatch.setattr(advisor, "MAX_KB_CHARS", 10_000)
+    ranked = advisor.load_kb_for_listing(listing)
+
+    cap = len(ranked[0]) + len(ranked[1]) - 1
+    assert any(len(c) <= len(ranked[1]) - 1 for c in ranked[2:])  # a later chunk would still fit
+    monkeypatch.setattr(advisor, "MAX_KB_CHARS", cap)
+    chunks = advisor.load_kb_for_listing(listing)
+    assert chunks == ranked[:1]
+    assert sum(map(len, chunks)) <= cap
+
+
+def test_first_chunk_is_kept_even_if_over_budget(kb, monkeypatch):
+    monkeypatch.setattr(advisor, "MAX_KB_CHARS", 1)
+    chunks = advisor.load_kb_for_listing({"brand": "BMW", "model": "Série 3"})
+    assert len(chunks) == 1 and "serie 3 note" in chunks[0]
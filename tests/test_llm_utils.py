@@ -0,0 +1,160 @@
+import asyncio, json
+
+import httpx, orjson
+import pytest
+
+from backend import llm_utils
+from backend.cache import make_key, response_cache
+from backend.extract_listing import extract_listings_batch
+from backend.llm_utils import _next_body, _read_choice, extract_json, post_chat, stream_chat_async
+
+
+def test_next_body_complete_reply():
+    assert _next_body({"finish_reason": "stop"}, {"max_tokens": 400}, 0) is None
+
+
+def test_next_body_doubles_then_gives_up(monkeypatch):
+    monkeypatch.setattr(llm_utils, "TRUNCATION_RETRIES", 1)
+    body = _next_body({"finish_reason": "length"}, {"max_tokens": 400, "model": "m"}, 0)
+    assert body == {"max_tokens": 800, "model": "m"}
+    with pytest.raises(RuntimeError, match="max_tokens=800"):
+        _next_body({"finish_reason": "length"}, body, 1)
+
+
+@pytest.mark.parametrize("text", [
+    ' {"a": 1}',
+    '```json\n{"a": 1}\n```',
+    'Sure, here it is: {"a": 1} hope this helps',
+])
+def test_extract_json(text):
+    assert extract_json(text) == {"a": 1}
+
+
+def test_extract_json_rejects_garbage():
+    with pytest.raises(ValueError):
+        extract_json('{"a": ')
+
+
+class _Resp:
+    def __init__(self, body, status_code=200):
+        self.status_code = status_code
+        self.content = orjson.dumps(body)
+        self.text = self.content.decode()
+
+
+def test_read_choice_returns_choice():
+    choice = {"message": {"content": "{}"}, "finish_reason": "stop"}
+    assert _read_choice(_Resp({"choices": [choice]})) == choice
+
+
+@pytest.mark.parametrize("body", [
+    {"choices": [{"message": {"content": None}}]},
+    {"choices": [{"message": {}}]},
+    {"choices": []},
+    {"error": "nope"},
+])
+def test_read_choice_rejects_malformed(body):
+    with pytest.raises(RuntimeError, match="Unexpected LLM response format"):
+        _read_choice(_Resp(body))
+
+
+def test_read_choice_http_error():
+    with pytest.raises(RuntimeError, match="LLM error 500"):
+        _read_choice(_Resp({}, status_code=500))
+
+
+class _FakeSession:
+    """Stands in for llm_utils.SESSION; replies with `content` and counts calls."""
+    def __init__(self, content):
+        self.content = content
+        self.calls = 0
+
+    def post(self, url, **kw):
+        self.calls += 1
+        return _Resp({"choices": [{"message": {"content": self.content}, "finish_reason": "stop"}]})
+
+
+@pytest.fixture
+def fake_session(monkeypatch):
+    response_cache.clear()
+    session = _FakeSession("")
+    monkeypatch.setattr(llm_utils, "SESSION", session)
+    yield session
+    response_cache.clear()
+
+
+def test_malformed_reply_is_not_cached(fake_session):
+    fake_session.content = json.dumps({"listings": [{"brand": "x"}]})
+    for _ in range(3):
+        with pytest.raises(ValueError, match="1 listings for 2 ads"):
+            extract_listings_batch(["ad1", "ad2"])
+    assert fake_session.calls == 3
+
+
+def test_parsed_reply_is_cached_and_copied(fake_session):
+    fake_session.content = '{"pros": ["ok"]}'
+    data = {"model": "m", "messages": [{"role": "user", "content": "x"}], "temperature": 0.0, "max_tokens": 10}
+    first = post_chat(data, timeout=1)
+    first["pros"].append("mutated")
+    assert post_chat(data, timeout=1) == {"pros": ["ok"]}
+    assert fake_session.calls == 1
+
+
+def _sse_body(*chunks, finish="stop"):
+    lines = [": keep-alive", ""]
+    for c in chunks:
+        lines += [f"data: {orjson.dumps({'choices': [{'delta': {'content': c}, 'finish_reason': None}]}).decode()}", ""]
+    lines += [f"data: {orjson.dumps({'choices': [{'delta': {}, 'finish_reason': finish}]}).decode()}", ""]
+    lines += ["data: [DONE]", "", "data: this line is after DONE and must be ignored", ""]
+    return "\n".join(lines).encode()
+
+
+def _stream(handler, data):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return [event async for event in stream_chat_async(data, client, timeout=1)]
+    return asyncio.run(run())
+
+
+@pytest.fixture
+def stream_data():
+    response_cache.clear()
+    yield {"model": "m", "messages": [{"role": "user", "content": "s"}], "temperature": 0.0, "max_tokens": 100}
+    response_cache.clear()
+
+
+def test_stream_parses_data_lines_until_done(stream_data):
+    sent = []
+
+    def handler(request):
+        sent.append(orjson.loads(request.content))
+        return httpx.Response(200, content=_sse_body('{"a":', ' 1}'))
+
+    assert _stream(handler, stream_data) == [("partial", '{"a":'), ("partial", " 1}"), ("final", {"a": 1})]
+    assert sent[0]["stream"] is True
+    assert sent[0]["max_tokens"] == 100 * 2 ** llm_utils.TRUNCATION_RETRIES
+
+
+def test_stream_cache_hit_yields_only_final(stream_data):
+    calls = []
+
+    def handler(request):
+        calls.append(1)
+        return httpx.Response(200, content=_sse_body('{"a": 1}'))
+
+    _stream(handler, stream_data)
+    assert _stream(handler, stream_data) == [("final", {"a": 1})]
+    assert len(calls) == 1
+
+
+def test_stream_http_error(stream_data):
+    handler = lambda request: httpx.Response(429, text="slow down")
+    with pytest.raises(RuntimeError, match="LLM error 429: slow down"):
+        _stream(handler, stream_data)
+
+
+def test_stream_truncation_raises_and_is_not_cached(stream_data):
+    handler = lambda request: httpx.Response(200, content=_sse_body('{"a":', finish="length"))
+    with pytest.raises(RuntimeError, match=f"truncated at max_tokens={100 * 2 ** llm_utils.TRUNCATION_RETRIES}"):
+        _stream(handler, stream_data)
+    assert response_cache.get(make_key(stream_data["model"], stream_data["messages"])) is None